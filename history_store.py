@@ -0,0 +1,134 @@
+"""
+Server-side conversation history for /api/chat.
+
+The browser only sends the newest user message; the full conversation lives here, keyed by the session
+cookie. It is kept in SQLite so every gunicorn worker on the host sees the same history without needing a
+separate session server.
+
+The alternatives generated by the last regenerate are kept too, tied to the assistant message they were
+generated for, so the client can switch between them by index without supplying any text itself.
+
+While a reply is being generated the session is marked as replying, so overlapping requests (from any
+worker) are turned away instead of interleaving their turns in the history.
+
+Long conversations also keep a running summary: the summary row with `upto = n` covers the session's first n
+messages, so a prompt only needs that summary plus the messages after it.
+"""
+import sqlite3
+import time
+
+
+class HistoryStore:
+    def __init__(self, path):
+        self.path = path
+        with self._connect() as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS messages ("
+                " id INTEGER PRIMARY KEY, session_id TEXT NOT NULL, role TEXT NOT NULL, content TEXT NOT NULL)"
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS messages_session ON messages (session_id, id)")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS summaries ("
+                " session_id TEXT NOT NULL, upto INTEGER NOT NULL, content TEXT NOT NULL,"
+                " PRIMARY KEY (session_id, upto))"
+            )
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS alternatives ("
+                " session_id TEXT NOT NULL, message_id INTEGER NOT NULL, idx INTEGER NOT NULL, content TEXT NOT NULL,"
+                " PRIMARY KEY (session_id, idx))"
+            )
+            db.execute("CREATE TABLE IF NOT EXISTS replying (session_id TEXT PRIMARY KEY, started REAL NOT NULL)")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    def load(self, session_id, start=0):
+        """Return the session's messages from position `start` on, oldest first, as OpenAI-style {role, content}."""
+        with self._connect() as db:
+            rows = db.execute(
+                "SELECT role, content FROM messages WHERE session_id = ? ORDER BY id LIMIT -1 OFFSET ?",
+                (session_id, start),
+            ).fetchall()
+        return [{'role': role, 'content': content} for role, content in rows]
+
+    def append(self, session_id, role, content):
+        with self._connect() as db:
+            db.execute(
+                "INSERT INTO messages (session_id, role, content) VALUES (?, ?, ?)", (session_id, role, content)
+            )
+
+    def replace_last(self, session_id, role, content):
+        """Overwrite the content of the session's newest message if it has `role`; return whether it did."""
+        with self._connect() as db:
+            cur = db.execute(
+                "UPDATE messages SET content = ? WHERE id = ("
+                " SELECT MAX(id) FROM messages WHERE session_id = ?) AND role = ?",
+                (content, session_id, role),
+            )
+        return cur.rowcount > 0
+
+    def remove_last(self, session_id, role):
+        """Delete the session's newest message if it has `role`."""
+        with self._connect() as db:
+            db.execute(
+                "DELETE FROM messages WHERE id = (SELECT MAX(id) FROM messages WHERE session_id = ?) AND role = ?",
+                (session_id, role),
+            )
+
+    def begin_reply(self, session_id, timeout):
+        """Mark the session as replying; return False if it already is (for less than `timeout` seconds).
+
+        The timeout only matters when a worker died mid-reply and never called end_reply().
+        """
+        now = time.time()
+        with self._connect() as db:
+            cur = db.execute(
+                "INSERT INTO replying (session_id, started) VALUES (?, ?)"
+                " ON CONFLICT (session_id) DO UPDATE SET started = excluded.started WHERE started < ?",
+                (session_id, now, now - timeout),
+            )
+        return cur.rowcount > 0
+
+    def end_reply(self, session_id):
+        with self._connect() as db:
+            db.execute("DELETE FROM replying WHERE session_id = ?", (session_id,))
+
+    def store_alternatives(self, session_id, replies):
+        """Remember `replies` as the alternatives for the session's newest message, replacing earlier ones."""
+        with self._connect() as db:
+            db.execute("DELETE FROM alternatives WHERE session_id = ?", (session_id,))
+            db.executemany(
+                "INSERT INTO alternatives (session_id, message_id, idx, content)"
+                " SELECT ?, MAX(id), ?, ? FROM messages WHERE session_id = ?",
+                [(session_id, i, reply, session_id) for i, reply in enumerate(replies)],
+            )
+
+    def choose_alternative(self, session_id, index):
+        """Show alternative `index` as the newest assistant message; return its content, or None if there is none.
+
+        Alternatives only apply while the message they were generated for is still the session's newest one.
+        """
+        with self._connect() as db:
+            row = db.execute(
+                "SELECT content FROM alternatives WHERE session_id = ? AND idx = ? AND message_id = ("
+                " SELECT MAX(id) FROM messages WHERE session_id = ?)",
+                (session_id, index, session_id),
+            ).fetchone()
+        if row is None or not self.replace_last(session_id, 'assistant', row[0]):
+            return None
+        return row[0]
+
+    def latest_summary(self, session_id):
+        """Return (upto, content) of the newest running summary, or (0, None) if there is none yet."""
+        with self._connect() as db:
+            row = db.execute(
+                "SELECT upto, content FROM summaries WHERE session_id = ? ORDER BY upto DESC LIMIT 1", (session_id,)
+            ).fetchone()
+        return row if row else (0, None)
+
+    def store_summary(self, session_id, upto, content):
+        with self._connect() as db:
+            db.execute(
+                "INSERT OR REPLACE INTO summaries (session_id, upto, content) VALUES (?, ?, ?)",
+                (session_id, upto, content),
+            )
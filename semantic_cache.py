@@ -0,0 +1,218 @@
+"""
+Semantic response cache for /api/chat.
+
+A reply is stored against an embedding of the user's latest message blended with a decayed sum of the
+embeddings of their earlier messages, so a paraphrase of a question that was already answered in the same
+context is served from the cache instead of calling the chat model.
+
+- Vectors are L2-normalised so inner product is cosine similarity.
+- Each entry also records (a digest of) the assistant reply its question followed, and is only served after
+  that same reply. The blended vector only sees the user's words, so otherwise a follow-up such as
+  "another one" or "why?" would be answered with the reply it got the previous time it was asked.
+- Every browser session gets its own index; one user's cache never answers another user.
+- Entries are persisted in SQLite and an index is rebuilt lazily the first time a session is seen by a
+  worker process, so the cache survives restarts and is shared by all gunicorn workers on the host
+  (entries added by another worker become visible once this worker reloads that session).
+- Indexes start as exact IndexFlatIP. Once pq_train_size entries exist, a product quantizer (m bytes per
+  vector instead of 4 * d) can be trained on them and stored in SQLite; workers pick it up within
+  codec_check_interval seconds and from then on every session index is an IndexPQ sharing that codebook,
+  which keeps in-RAM caches small. Training takes several seconds of CPU, so it is a one-off offline step
+  rather than something a request does:
+      uv run semantic_cache.py train [CACHE_DB]
+  Candidates found in the quantized index are re-ranked against the exact vectors from SQLite, so the
+  similarity threshold is applied to true cosine.
+  Per-session namespaces are small, so the scan over PQ codes is used as is rather than an IVF partition.
+"""
+from collections import OrderedDict
+import hashlib
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+import faiss
+import numpy as np
+
+
+class SemanticCache:
+    def __init__(self, client, path, embedding_model, threshold=0.87, alpha=0.7, decay=0.5,
+                 context_turns=3, max_sessions=1024, max_embeddings=4096, pq_train_size=10000, pq_m=16,
+                 pq_nbits=8, rerank=4, codec_check_interval=60.0):
+        self.client = client
+        self.path = path
+        self.embedding_model = embedding_model
+        self.threshold = threshold
+        self.alpha = alpha
+        self.decay = decay
+        self.context_turns = context_turns
+        self.max_sessions = max_sessions
+        self.max_embeddings = max_embeddings
+        self.pq_train_size = pq_train_size
+        self.pq_m = pq_m
+        self.pq_nbits = pq_nbits
+        self.rerank = rerank
+        self.codec_check_interval = codec_check_interval
+        self._lock = threading.Lock()
+        self._codec = None                # trained, empty IndexPQ cloned for every session once available
+        self._codec_checked = None        # time.monotonic() of the last look for a stored codebook
+        self._indexes = OrderedDict()     # session_id -> faiss index, least recently used first
+        self._embeddings = OrderedDict()  # text -> normalised embedding, so earlier turns are embedded once
+        with self._connect() as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS cache_entries ("
+                " id INTEGER PRIMARY KEY, session_id TEXT NOT NULL, vector BLOB NOT NULL, reply TEXT NOT NULL,"
+                " previous_reply TEXT)"
+            )
+            if 'previous_reply' not in [c[1] for c in db.execute("PRAGMA table_info(cache_entries)")]:
+                # Entries from before the column existed have no known context and are never served
+                db.execute("ALTER TABLE cache_entries ADD COLUMN previous_reply TEXT")
+            db.execute("CREATE INDEX IF NOT EXISTS cache_entries_session ON cache_entries (session_id)")
+            db.execute("CREATE TABLE IF NOT EXISTS cache_codec (id INTEGER PRIMARY KEY CHECK (id = 1), data BLOB NOT NULL)")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=10)
+
+    def embed_context(self, user_turns):
+        """Return the blended query vector for a list of user messages, latest last."""
+        turns = user_turns[-(self.context_turns + 1):]
+        vectors = self._embed(turns)
+        query = vectors[-1]
+        if len(vectors) > 1:
+            # alpha * q + (1 - alpha) * sum(decay^i * prev_i), nearest previous turn first
+            prior = sum(self.decay ** i * v for i, v in enumerate(reversed(vectors[:-1]), start=1))
+            query = self.alpha * query + (1 - self.alpha) * prior
+        return _normalise(query)
+
+    def lookup(self, session_id, vector, previous_reply=''):
+        """Return the cached reply closest to `vector` if it is similar enough, else None.
+
+        Only entries stored after the same `previous_reply` (the assistant message before the user's turn,
+        '' on the first turn) are considered.
+        """
+        with self._lock:
+            self._load_codec()
+            index = self._index(session_id)
+            if index is None or index.ntotal == 0:
+                return None
+            _, ids = index.search(vector.reshape(1, -1), min(self.rerank, index.ntotal))
+        candidates = [int(i) for i in ids[0] if i >= 0]
+        with self._connect() as db:
+            rows = db.execute(
+                f"SELECT vector, reply FROM cache_entries WHERE id IN ({','.join('?' * len(candidates))})"
+                " AND previous_reply = ?",
+                [*candidates, _digest(previous_reply)],
+            ).fetchall()
+        best_sim, best_reply = -1.0, None
+        for v, reply in rows:
+            sim = float(np.dot(np.frombuffer(v, dtype=np.float32), vector))
+            if sim > best_sim:
+                best_sim, best_reply = sim, reply
+        return best_reply if best_sim >= self.threshold else None
+
+    def store(self, session_id, vector, reply, previous_reply=''):
+        with self._lock:
+            self._load_codec()
+            # Load the session's index before inserting so the new row is not added to it twice
+            index = self._index(session_id, dim=vector.shape[0])
+            with self._connect() as db:
+                cur = db.execute(
+                    "INSERT INTO cache_entries (session_id, vector, reply, previous_reply) VALUES (?, ?, ?, ?)",
+                    (session_id, vector.tobytes(), reply, _digest(previous_reply)),
+                )
+            index.add_with_ids(vector.reshape(1, -1), np.array([cur.lastrowid], dtype=np.int64))
+
+    def _embed(self, texts):
+        found = {t: self._embeddings.get(t) for t in texts}
+        missing = [t for t, v in found.items() if v is None]
+        if missing:
+            resp = self.client.embeddings.create(model=self.embedding_model, input=missing)
+            for text, item in zip(missing, resp.data):
+                found[text] = _normalise(np.asarray(item.embedding, dtype=np.float32))
+        for t, v in found.items():
+            self._embeddings[t] = v
+            self._embeddings.move_to_end(t)
+        while len(self._embeddings) > self.max_embeddings:
+            self._embeddings.popitem(last=False)
+        return [found[t] for t in texts]
+
+    def _index(self, session_id, dim=None):
+        # Caller holds self._lock. Loads the session's entries from SQLite on first use in this process.
+        index = self._indexes.get(session_id)
+        if index is None:
+            with self._connect() as db:
+                rows = db.execute(
+                    "SELECT id, vector FROM cache_entries WHERE session_id = ?", (session_id,)
+                ).fetchall()
+            if rows:
+                vectors = np.stack([np.frombuffer(v, dtype=np.float32) for _, v in rows])
+                dim = vectors.shape[1]
+            if dim is None:
+                return None
+            index = self._new_index(dim)
+            if rows:
+                index.add_with_ids(vectors, np.array([i for i, _ in rows], dtype=np.int64))
+            self._indexes[session_id] = index
+            while len(self._indexes) > self.max_sessions:
+                self._indexes.popitem(last=False)
+        self._indexes.move_to_end(session_id)
+        return index
+
+    def _new_index(self, dim):
+        if self._codec is not None and self._codec.d == dim:
+            return faiss.IndexIDMap(faiss.clone_index(self._codec))
+        return faiss.IndexIDMap(faiss.IndexFlatIP(dim))
+
+    def _load_codec(self):
+        # Caller holds self._lock. Picks up a stored codebook, looking at most every codec_check_interval.
+        now = time.monotonic()
+        if self._codec is not None or (
+                self._codec_checked is not None and now - self._codec_checked < self.codec_check_interval):
+            return
+        self._codec_checked = now
+        with self._connect() as db:
+            row = db.execute("SELECT data FROM cache_codec WHERE id = 1").fetchone()
+        if row:
+            self._codec = faiss.deserialize_index(np.frombuffer(row[0], dtype=np.uint8))
+            self._indexes.clear()  # rebuilt on next use with quantized codes
+
+    def train_codec(self):
+        """Train and store the product quantizer on a sample of all cached vectors; return whether one was stored.
+
+        Meant to be run once, offline (see the module docstring), not from a request.
+        """
+        with self._connect() as db:
+            if db.execute("SELECT 1 FROM cache_codec WHERE id = 1").fetchone():
+                return False
+            rows = db.execute(
+                "SELECT vector FROM cache_entries ORDER BY RANDOM() LIMIT ?", (self.pq_train_size,)
+            ).fetchall()
+        if len(rows) < self.pq_train_size:
+            return False
+        vectors = np.stack([np.frombuffer(v, dtype=np.float32) for (v,) in rows])
+        if vectors.shape[1] % self.pq_m:
+            return False
+        codec = faiss.IndexPQ(vectors.shape[1], self.pq_m, self.pq_nbits, faiss.METRIC_INNER_PRODUCT)
+        codec.train(vectors)
+        with self._connect() as db:
+            db.execute("INSERT OR IGNORE INTO cache_codec (id, data) VALUES (1, ?)",
+                       (faiss.serialize_index(codec).tobytes(),))
+        return True
+
+def _normalise(v):
+    return (v / (np.linalg.norm(v) or 1.0)).astype(np.float32)
+
+
+def _digest(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()[:16]
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] != ['train']:
+        sys.exit("usage: semantic_cache.py train [CACHE_DB]")
+    path = sys.argv[2] if len(sys.argv) > 2 else os.environ.get("CACHE_DB", "chat_cache.db")
+    cache = SemanticCache(None, path, embedding_model=None)
+    if cache.train_codec():
+        print(f"trained and stored the product quantizer in {path}")
+    else:
+        print(f"nothing to do: {path} already has a codebook or fewer than {cache.pq_train_size} entries")
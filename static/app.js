@@ -0,0 +1,240 @@
+const apiBase = '/api/chat';
+const messagesEl = document.getElementById('messages');
+const inputEl = document.getElementById('input');
+const sendBtn = document.getElementById('send');
+const regenerateBtn = document.getElementById('regenerate');
+
+// The server keeps the conversation; localStorage is only used to redraw it on reload.
+// Messages are stored as one string of frames, <role tag><content length in base 36>:<content>, which avoids
+// repeating JSON keys per message and decodes with plain slicing. The decoded history is kept in memory.
+const HISTORY_KEY = 'cute_chat_history_v2';
+const LEGACY_HISTORY_KEY = 'cute_chat_history';
+let historyCache = null;
+
+function loadHistory(){
+  if(historyCache) return historyCache;
+  const raw = localStorage.getItem(HISTORY_KEY);
+  try{
+    historyCache = raw ? decodeHistory(raw) : loadLegacyHistory();
+  }catch(e){
+    historyCache = [];
+  }
+  return historyCache;
+}
+
+function saveHistory(history){
+  historyCache = history;
+  localStorage.setItem(HISTORY_KEY, history.map(encodeMessage).join(''));
+}
+
+function encodeMessage(m){
+  return (m.role === 'user' ? 'u' : 'a') + m.content.length.toString(36) + ':' + m.content;
+}
+
+function decodeHistory(raw){
+  const history = [];
+  let i = 0;
+  while(i < raw.length){
+    const colon = raw.indexOf(':', i + 1);
+    if(colon < 0) throw new Error('corrupt history');
+    const start = colon + 1, end = start + parseInt(raw.slice(i + 1, colon), 36);
+    history.push({role: raw[i] === 'u' ? 'user' : 'assistant', content: raw.slice(start, end)});
+    i = end;
+  }
+  return history;
+}
+
+// Histories saved as JSON by earlier versions are converted once.
+function loadLegacyHistory(){
+  const raw = localStorage.getItem(LEGACY_HISTORY_KEY);
+  if(!raw) return [];
+  localStorage.removeItem(LEGACY_HISTORY_KEY);
+  const history = JSON.parse(raw);
+  saveHistory(history);
+  return history;
+}
+
+const URL_RE = /https?:\/\/\S+/g;
+
+// Add one message bubble to the end of the list and return its content element.
+function appendMessage(m){
+  const div = document.createElement('div');
+  div.className = 'msg ' + (m.role === 'user' ? 'user' : 'bot');
+  const meta = document.createElement('div'); meta.className='meta';
+  meta.textContent = m.role === 'user' ? 'You' : 'Assistant';
+  const content = document.createElement('div'); content.className='content';
+  setContent(content, m.content);
+  div.appendChild(meta);
+  div.appendChild(content);
+  messagesEl.appendChild(div);
+  bubbleContent.set(div, content);
+  windowObserver.observe(div);
+  scrollToBottom();
+  return content;
+}
+
+// Bubbles far outside the visible part of the list are emptied (keeping their height, so scrolling is
+// unaffected) and refilled when they come back near the viewport, keeping long chats cheap to lay out.
+const bubbleContent = new WeakMap();
+const detachedChildren = new WeakMap();
+const windowObserver = new IntersectionObserver((entries)=>{
+  for(const entry of entries){
+    const div = entry.target;
+    const children = detachedChildren.get(div);
+    if(entry.isIntersecting && children){
+      div.replaceChildren(...children);
+      div.style.height = '';
+      detachedChildren.delete(div);
+    }else if(!entry.isIntersecting && !children){
+      div.style.height = entry.boundingClientRect.height + 'px';
+      detachedChildren.set(div, [...div.childNodes]);
+      div.replaceChildren();
+    }
+  }
+}, {root: messagesEl, rootMargin: '1500px 0px'});
+
+// Text is assigned via text nodes so it never needs HTML escaping; URLs are then split out into links.
+function setContent(el, text){
+  el.textContent = text;
+  let node = el.firstChild, offset = 0, match;
+  URL_RE.lastIndex = 0;
+  while(node && (match = URL_RE.exec(text))){
+    const urlNode = node.splitText(match.index - offset);
+    node = urlNode.splitText(match[0].length);
+    offset = match.index + match[0].length;
+    const a = document.createElement('a');
+    a.href = match[0]; a.target = '_blank'; a.rel = 'noopener';
+    el.replaceChild(a, urlNode);
+    a.appendChild(urlNode);
+  }
+}
+
+// Keep the newest message in view, at most once per animation frame.
+let scrollPending = false;
+function scrollToBottom(){
+  if(scrollPending) return;
+  scrollPending = true;
+  requestAnimationFrame(()=>{ scrollPending = false; messagesEl.scrollTop = messagesEl.scrollHeight; });
+}
+
+// One request at a time: the server answers a session's turns in order and turns away overlapping ones (409).
+function setBusy(busy){
+  sendBtn.disabled = busy;
+  regenerateBtn.disabled = busy;
+}
+
+async function sendMessage(){
+  const raw = inputEl.value.trim();
+  if(!raw || sendBtn.disabled) return;
+  setBusy(true);
+  inputEl.value='';
+  alternatives = [];
+  // append to local history and render
+  const history = loadHistory();
+  history.push({role:'user', content: raw});
+  appendMessage(history[history.length - 1]);
+  saveHistory(history);
+
+  // show typing placeholder; the reply streams into this bubble
+  const botContent = appendMessage({role:'assistant', content:'…'});
+
+  try{
+    const resp = await fetch(apiBase, {
+      method:'POST', headers:{'Content-Type':'application/json'},
+      body: JSON.stringify({message: raw})
+    });
+    if(!resp.ok){
+      throw new Error('Server error: '+resp.statusText);
+    }
+    // consume the SSE stream, growing a single text node in place (no escaping, no per-delta nodes)
+    const streamText = document.createTextNode('');
+    await readStream(resp, (delta)=>{
+      if(!streamText.parentNode) botContent.replaceChildren(streamText);
+      streamText.appendData(delta);
+      scrollToBottom();
+    });
+    const reply = streamText.data.trim();
+    history.push({role:'assistant', content: reply});
+    saveHistory(history);
+    setContent(botContent, reply);
+  }catch(err){
+    history.push({role:'assistant', content: 'Error: '+err.message});
+    saveHistory(history);
+    setContent(botContent, 'Error: '+err.message);
+  }finally{
+    setBusy(false);
+  }
+}
+
+// Read `data: {...}` events from a text/event-stream response, calling onDelta per chunk.
+async function readStream(resp, onDelta){
+  const reader = resp.body.getReader();
+  const decoder = new TextDecoder('utf-8');
+  let buffer = '';
+  while(true){
+    const {value, done} = await reader.read();
+    if(done) break;
+    buffer += decoder.decode(value, {stream:true});
+    const events = buffer.split('\n\n');
+    buffer = events.pop();
+    for(const ev of events){
+      if(!ev.startsWith('data: ')) continue;
+      const payload = ev.slice(6);
+      if(payload === '[DONE]') return;
+      const data = JSON.parse(payload);
+      if(data.error) throw new Error(data.error);
+      onDelta(data.delta);
+    }
+  }
+}
+
+// Alternative replies to the latest user turn; fetched n at a time, then picked by index (the server keeps them).
+let alternatives = [];
+let alternativeIndex = 0;
+
+async function regenerateReply(){
+  const history = loadHistory();
+  if(!history.length || regenerateBtn.disabled) return;
+  setBusy(true);
+  let botContent;
+  if(history[history.length - 1].role === 'assistant'){
+    botContent = bubbleContent.get(messagesEl.lastElementChild);
+  }else{
+    botContent = appendMessage({role:'assistant', content:''});
+    history.push({role:'assistant', content:''});
+  }
+  const next = alternativeIndex + 1 < alternatives.length;
+  if(!next) setContent(botContent, '…');
+  try{
+    const resp = await fetch('/api/regenerate', {
+      method:'POST', headers:{'Content-Type':'application/json'},
+      body: JSON.stringify(next ? {choice: alternativeIndex + 1} : {})
+    });
+    if(!resp.ok){
+      throw new Error('Server error: '+resp.statusText);
+    }
+    const data = await resp.json();
+    if(next){
+      alternativeIndex++;
+      history[history.length - 1].content = data.reply;
+    }else{
+      alternatives = data.replies;
+      alternativeIndex = 0;
+      history[history.length - 1].content = alternatives[0];
+    }
+  }catch(err){
+    history[history.length - 1].content = 'Error: '+err.message;
+  }
+  saveHistory(history);
+  setContent(botContent, history[history.length - 1].content);
+  setBusy(false);
+}
+
+sendBtn.addEventListener('click', sendMessage);
+regenerateBtn.addEventListener('click', regenerateReply);
+inputEl.addEventListener('keydown', (e)=>{
+  if(e.key === 'Enter' && !e.shiftKey){ e.preventDefault(); sendMessage(); }
+});
+
+// initialize
+loadHistory().forEach(appendMessage);
@@ -2,37 +2,198 @@
 Simple Chat — single-file Python web app (Flask) that hosts a web client chat UI.
 
 How it works
-- Frontend (served at /) is a simple HTML + CSS + JavaScript single page app.
-- Conversation history is kept in the browser's session (localStorage) so memory is per-browser session.
-- Each time the user sends a message the whole conversation (history) is POSTed to /api/chat where
-  the server forwards it to OpenAI using the Python SDK. The response is returned and appended by the client.
+- Frontend (served at /) is a simple HTML + CSS + JavaScript single page app. The CSS and JavaScript live in
+  static/ and are precompressed (brotli and gzip) at startup and served with long-lived cache headers.
+- Conversation history is kept server-side per browser session (see history_store.py), keyed by a session
+  cookie. The browser keeps a copy in localStorage for display only.
+- Each time the user sends a message only that message is POSTed to /api/chat; the server appends it to the
+  stored history and forwards the conversation to OpenAI using the Python SDK. The reply is streamed back as
+  server-sent events and appended to the last chat bubble by the client as it arrives.
+- Before calling the chat model, the latest user message is looked up in a per-session semantic cache
+  (see semantic_cache.py); close paraphrases of an earlier question are answered from the cache.
 
 Security & setup
 - Do NOT hardcode your API key. Export it as an environment variable:
     export OPENAI_API_KEY="sk-..."
 - Optional: set MODEL env var to your preferred chat model (defaults to "gpt-4o-mini").
-- Install requirements: pip install flask openai python-dotenv
-- Run: python cute_pastel_chat_app.py
+- Optional: HISTORY_DB (SQLite file for conversations, defaults to "chat_history.db").
+- Optional: CACHE_DB (SQLite file for the semantic reply cache, defaults to "chat_cache.db"),
+  EMBEDDING_MODEL (defaults to "text-embedding-3-small") and CACHE_THRESHOLD (cosine similarity, 0.87).
+- Install requirements: uv sync
+- Run locally: uv run webapp.py (set FLASK_DEBUG=1 for the reloader and debugger)
+- Run in production: uv run gunicorn -k gevent -w 4 --worker-connections 1000 -b 0.0.0.0:7860 wsgi:app
+- Behind a reverse proxy or CDN, set TRUSTED_PROXIES to the number of proxies in front of the app so client
+  IPs (used for the per-IP rate limits) are read from X-Forwarded-For instead of being the proxy's address.
 
 Notes
-- This file is intentionally self-contained for demo/learning. For production, add rate-limiting, auth,
-  improved error handling, and do not send very long conversation histories without trimming.
+- Long conversations are trimmed before they are sent: recent messages are kept verbatim and older ones are
+  folded, SUMMARY_CHUNK at a time, into a running summary from SUMMARY_MODEL that is stored with the history.
+- Requests are rate limited per session and per IP, and prompt tokens are metered per session (see
+  CHAT_RATE_LIMIT, IP_RATE_LIMIT, TOKEN_RATE_LIMIT, IP_TOKEN_RATE_LIMIT and RATELIMIT_STORAGE_URI).
+- This app is intentionally small and self-contained for demo/learning. For production, add auth
+  and improved error handling.
 
 """
-from flask import Flask, request, jsonify, render_template_string
+from flask import Flask, Response, after_this_request, g, request, jsonify, stream_with_context
+from flask.json.provider import JSONProvider
+from flask_limiter import Limiter
+from flask_limiter.util import get_remote_address
+from limits import parse as parse_limit
+from werkzeug.middleware.proxy_fix import ProxyFix
+import gzip
+import hashlib
 import os
+import re
+import uuid
+import brotli
+import fastjsonschema
+import httpx
 import openai
+import orjson
+import tiktoken
 
-app = Flask(__name__)
+from history_store import HistoryStore
+from semantic_cache import SemanticCache
+
+# static/ is served by the precompressing route below rather than Flask's default static view
+app = Flask(__name__, static_folder=None)
+
+class ORJSONProvider(JSONProvider):
+    """Route request.get_json() and jsonify() through orjson, which is several times faster than stdlib json."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+app.json = ORJSONProvider(app)
+
+# Only trust as many X-Forwarded-* hops as there are proxies we run; a client can send the headers itself
+TRUSTED_PROXIES = int(os.environ.get("TRUSTED_PROXIES", "0"))
+if TRUSTED_PROXIES:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES, x_proto=TRUSTED_PROXIES)
 
 # Read API key from environment
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
 if not OPENAI_API_KEY:
     raise RuntimeError("Please set the OPENAI_API_KEY environment variable before running this app.")
-openai.api_key = OPENAI_API_KEY
 
 MODEL = os.environ.get("MODEL", "gpt-4o-mini")
 
+# One shared client for the whole process so TLS connections to OpenAI are pooled and reused.
+# HTTP/2 multiplexes concurrent requests over those connections instead of opening one per in-flight call.
+client = openai.OpenAI(
+    api_key=OPENAI_API_KEY,
+    http_client=httpx.Client(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=64, max_connections=128, keepalive_expiry=60.0),
+        timeout=httpx.Timeout(60.0, connect=5.0),
+    ),
+)
+
+# We will add a friendly system prompt to keep tone cute.
+# Every prompt starts with this exact message so OpenAI's prompt cache can reuse the shared prefix.
+SYSTEM_PROMPT = (
+    "You are a friendly, concise, cute assistant that replies helpfully and briefly. "
+    "Keep responses pleasant and slightly playful, suitable for a pastel-themed chat UI."
+)
+SYSTEM_MSG = {'role': 'system', 'content': SYSTEM_PROMPT}
+
+# Number of streamed token deltas merged into one server-sent event
+STREAM_BATCH_SIZE = 12
+
+# Requests are validated before any work is done so oversized prompts are rejected, not forwarded to OpenAI
+MAX_MESSAGE_CHARS = 8000
+validate_chat_request = fastjsonschema.compile({
+    'type': 'object',
+    'properties': {'message': {'type': 'string', 'pattern': r'\S', 'maxLength': MAX_MESSAGE_CHARS}},
+    'required': ['message'],
+})
+validate_regenerate_request = fastjsonschema.compile({
+    'type': 'object',
+    'properties': {'choice': {'type': 'integer', 'minimum': 0}},
+})
+
+# Replies are capped at MAX_REPLY_TOKENS. Greetings and acknowledgements get SHORT_REPLY_TOKENS and stop at
+# the first paragraph, so they don't get (and wait for) long answers; a short question can still need a long
+# answer ("explain TCP in detail"), so nothing else is cut down by its length.
+MAX_REPLY_TOKENS = 512
+SHORT_REPLY_TOKENS = 32
+# Only messages that are nothing but a greeting/acknowledgement (plus punctuation or emoji) count as short.
+SHORT_PROMPT_RE = re.compile(r"^\s*(hi|hello|hey|thanks|thank you|ok|okay|bye)\W*$", re.IGNORECASE)
+
+# Regenerating asks for this many alternative replies in one request (n=...); the client cycles through them by index
+REGENERATE_CHOICES = 4
+
+# Long conversations keep at least the last HISTORY_WINDOW messages verbatim and fold older ones into a
+# running summary once the prompt exceeds CONTEXT_TOKENS (counted with tiktoken), or more than
+# MAX_HISTORY_MESSAGES follow the summary. Messages are folded SUMMARY_CHUNK at a time, so the prompt prefix
+# (system prompt, summary, oldest kept turns) stays identical for several turns between folds.
+HISTORY_WINDOW = 20
+SUMMARY_CHUNK = 10
+MAX_HISTORY_MESSAGES = 200
+CONTEXT_TOKENS = int(os.environ.get("CONTEXT_TOKENS", "8000"))
+SUMMARY_MODEL = os.environ.get("SUMMARY_MODEL", "gpt-4o-mini")
+# Messages older than the newest turn are cut to their first and last MESSAGE_KEEP_CHARS / 2 characters
+MESSAGE_KEEP_CHARS = 4000
+
+# Server-side state is namespaced per browser by an opaque session cookie
+SESSION_COOKIE = 'sid'
+histories = HistoryStore(os.environ.get("HISTORY_DB", "chat_history.db"))
+# A session answers one turn at a time; a reply still marked in progress after REPLY_TIMEOUT seconds is
+# assumed to belong to a worker that died
+REPLY_TIMEOUT = 300
+
+# Rate limits keep one client from using up the shared OpenAI quota (and slowing everyone else down):
+# requests and prompt tokens, each per session and per IP. The session cookie is client-supplied, so the
+# per-IP limits are what holds against clients that rotate it. For several workers, point
+# RATELIMIT_STORAGE_URI at a shared store such as redis://localhost:6379 so they share the counters.
+CHAT_RATE_LIMIT = os.environ.get("CHAT_RATE_LIMIT", "30/minute")
+IP_RATE_LIMIT = os.environ.get("IP_RATE_LIMIT", "120/minute")
+TOKEN_RATE_LIMIT = parse_limit(os.environ.get("TOKEN_RATE_LIMIT", "40000/minute"))
+IP_TOKEN_RATE_LIMIT = parse_limit(os.environ.get("IP_TOKEN_RATE_LIMIT", "160000/minute"))
+
+def rate_limit_key():
+    return request.cookies.get(SESSION_COOKIE) or get_remote_address()
+
+limiter = Limiter(rate_limit_key, app=app, storage_uri=os.environ.get("RATELIMIT_STORAGE_URI", "memory://"))
+
+# tiktoken downloads the encoding's BPE file on first use and keeps it in TIKTOKEN_CACHE_DIR; hosts without
+# network access need it fetched there in advance (see README). Without it, tokens are estimated from length.
+CHARS_PER_TOKEN = 4
+try:
+    ENCODING_NAME = tiktoken.encoding_name_for_model(MODEL)
+except KeyError:
+    ENCODING_NAME = "o200k_base"
+try:
+    ENCODING = tiktoken.get_encoding(ENCODING_NAME)
+except Exception as e:
+    app.logger.warning('tiktoken encoding %s unavailable, estimating token counts: %s', ENCODING_NAME, e)
+    ENCODING = None
+
+# hash(content) -> token count. Keyed on the hash, not the text, so cached turns don't keep their strings alive.
+TOKEN_COUNT_CACHE_SIZE = 65536
+_tok_cache = {}
+
+def tok_count(content):
+    # Earlier turns are counted again every request; caching keeps that to a hash lookup
+    h = hash(content)
+    n = _tok_cache.get(h)
+    if n is None:
+        n = _tok_cache[h] = len(ENCODING.encode(content)) if ENCODING else len(content) // CHARS_PER_TOKEN + 1
+        if len(_tok_cache) > TOKEN_COUNT_CACHE_SIZE:
+            del _tok_cache[next(iter(_tok_cache))]  # oldest entry first
+    return n
+
+# Paraphrases of a question already answered in the same session are replied to from this cache
+cache = SemanticCache(
+    client,
+    path=os.environ.get("CACHE_DB", "chat_cache.db"),
+    embedding_model=os.environ.get("EMBEDDING_MODEL", "text-embedding-3-small"),
+    threshold=float(os.environ.get("CACHE_THRESHOLD", "0.87")),
+)
+
 INDEX_HTML = r"""
 <!doctype html>
 <html lang="en">
@@ -40,46 +201,7 @@ INDEX_HTML = r"""
   <meta charset="utf-8" />
   <meta name="viewport" content="width=device-width, initial-scale=1" />
   <title>My AI</title>
-  <style>
-    :root{
-      --bg:#FFF8FD;
-      --card:#FFF;
-      --accent:#F6D6FF;
-      --muted:#8A7E86;
-      --bubble-user:#D0F4FF;
-      --bubble-bot:#FFF1D6;
-      --radius:14px;
-      font-family: Inter, ui-sans-serif, system-ui, -apple-system, 'Segoe UI', Roboto, 'Helvetica Neue', Arial;
-    }
-    html,body{height:100%;margin:0;background:linear-gradient(180deg,var(--bg),#FFF);}
-    .app{max-width:820px;margin:28px auto;height:calc(100vh - 56px);display:flex;flex-direction:column;gap:12px;padding:18px}
-    header{display:flex;align-items:center;gap:12px}
-    .logo{width:54px;height:54px;border-radius:12px;background:linear-gradient(135deg,var(--accent),#FFE8F0);display:flex;align-items:center;justify-content:center;box-shadow:0 6px 18px rgba(0,0,0,0.06)}
-    .logo span{font-weight:700;color:#7B4DAF}
-    h1{font-size:20px;margin:0}
-    p.lead{margin:0;color:var(--muted);font-size:13px}
-
-    .chat-window{flex:1;background:var(--card);border-radius:18px;padding:18px;box-shadow:0 8px 30px rgba(124, 82, 153, 0.06);display:flex;flex-direction:column;overflow:hidden}
-    .messages{flex:1;overflow:auto;padding-right:6px;display:flex;flex-direction:column;gap:12px}
-    .msg{max-width:78%;padding:12px 14px;border-radius:12px;line-height:1.4}
-    .msg.user{margin-left:auto;background:var(--bubble-user);border-bottom-right-radius:6px}
-    .msg.bot{margin-right:auto;background:var(--bubble-bot);border-bottom-left-radius:6px}
-    .meta{font-size:11px;color:var(--muted);margin-bottom:6px}
-
-    .composer{display:flex;gap:8px;padding-top:10px}
-    .input{flex:1;display:flex;background:linear-gradient(0deg,#fff,#fff);border-radius:12px;padding:8px}
-    textarea{resize:none;border:0;outline:none;background:transparent;padding:8px;font-size:14px;width:100%;min-height:44px}
-    button.send{background:linear-gradient(135deg,#8EC5FF,#BBA6FF);border:0;color:white;padding:10px 14px;border-radius:12px;font-weight:600;cursor:pointer}
-    .small{font-size:12px;color:var(--muted)}
-
-    footer{display:flex;justify-content:space-between;align-items:center}
-
-    /* cute floating pet */
-    .pet{position:absolute;right:28px;bottom:28px;width:86px;height:86px;border-radius:50%;background:linear-gradient(135deg,#FFF0F7,#FFF9E6);display:flex;align-items:center;justify-content:center;box-shadow:0 10px 30px rgba(124,82,153,0.08)}
-    .pet .face{font-size:28px}
-
-    @media(max-width:600px){.app{margin:12px;padding:12px}}
-  </style>
+  <link rel="stylesheet" href="/static/app.css?v=%APP_CSS_VERSION%" />
 </head>
 <body>
   <div class="app">
@@ -87,7 +209,7 @@ INDEX_HTML = r"""
       <div class="logo"><span>✦</span></div>
       <div>
         <h1>My AI</h1>
-        <p class="lead">Conversation is stored in your browser session and handled locally.</p>
+        <p class="lead">Conversation is remembered for this browser session.</p>
       </div>
     </header>
 
@@ -98,147 +220,320 @@ INDEX_HTML = r"""
         <div class="input">
           <textarea id="input" placeholder="Say hi..." rows="1"></textarea>
         </div>
+        <button id="regenerate" class="send" title="Regenerate the last reply">↻</button>
         <button id="send" class="send">Send</button>
       </div>
     </main>
 
     <footer>
       <div class="small">Model: <span id="model-name">%MODEL%</span></div>
-      <div class="small">Session memory: localStorage</div>
+      <div class="small">Session memory: server</div>
     </footer>
 
     <div class="pet" title="Cute helper"><div class="face">(◕‿◕)</div></div>
   </div>
 
-<script>
-const apiBase = '/api/chat';
-const messagesEl = document.getElementById('messages');
-const inputEl = document.getElementById('input');
-const sendBtn = document.getElementById('send');
-const modelNameEl = document.getElementById('model-name');
-modelNameEl.textContent = '%MODEL%';
-
-// Load history from session (localStorage)
-function loadHistory(){
-  const raw = localStorage.getItem('cute_chat_history');
-  if(!raw) return [];
-  try{ return JSON.parse(raw);}catch(e){return []}
-}
-
-function saveHistory(history){
-  localStorage.setItem('cute_chat_history', JSON.stringify(history));
-}
-
-function renderMessages(history){
-  messagesEl.innerHTML='';
-  history.forEach((m)=>{
-    const div = document.createElement('div');
-    div.className = 'msg ' + (m.role === 'user' ? 'user' : 'bot');
-    const meta = document.createElement('div'); meta.className='meta';
-    meta.textContent = m.role === 'user' ? 'You' : 'Assistant';
-    const content = document.createElement('div'); content.innerHTML = linkify(escapeHtml(m.content)).replace(/\n/g,'<br>');
-    div.appendChild(meta);
-    div.appendChild(content);
-    messagesEl.appendChild(div);
-  });
-  // auto-scroll to bottom
-  messagesEl.scrollTop = messagesEl.scrollHeight;
-}
-
-function escapeHtml(unsafe){return unsafe.replace(/[&<>"']/g,function(c){return{'&':'&amp;','<':'&lt;','>':'&gt;','"':'&quot;',"'":"&#039;"}[c];});}
-function linkify(text){ return text.replace(/(https?:\/\/[^\s]+)/g, '<a href="$1" target="_blank" rel="noopener">$1</a>'); }
-
-async function sendMessage(){
-  const raw = inputEl.value.trim();
-  if(!raw) return;
-  inputEl.value='';
-  // append to local history and render
-  const history = loadHistory();
-  history.push({role:'user', content: raw});
-  renderMessages(history);
-  saveHistory(history);
-
-  // show typing placeholder
-  const typingPlaceholder = {role:'assistant', content:'…'};
-  history.push(typingPlaceholder);
-  renderMessages(history);
-
-  try{
-    const resp = await fetch(apiBase, {
-      method:'POST', headers:{'Content-Type':'application/json'},
-      body: JSON.stringify({messages: history.filter(m=>m.content !== '…')})
-    });
-    if(!resp.ok){
-      throw new Error('Server error: '+resp.statusText);
-    }
-    const data = await resp.json();
-    // replace last placeholder with assistant message
-    history.pop();
-    history.push({role:'assistant', content: data.reply});
-    saveHistory(history);
-    renderMessages(history);
-  }catch(err){
-    history.pop();
-    history.push({role:'assistant', content: 'Error: '+err.message});
-    saveHistory(history);
-    renderMessages(history);
-  }
-}
-
-sendBtn.addEventListener('click', sendMessage);
-inputEl.addEventListener('keydown', (e)=>{
-  if(e.key === 'Enter' && !e.shiftKey){ e.preventDefault(); sendMessage(); }
-});
-
-// initialize
-renderMessages(loadHistory());
-</script>
+<script src="/static/app.js?v=%APP_JS_VERSION%" defer></script>
 </body>
 </html>
 """
 
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+STATIC_TYPES = {'.css': 'text/css', '.js': 'text/javascript'}
+
+def load_static_assets():
+    # Read and compress every asset once at startup; requests then only pick the right encoding
+    assets = {}
+    for name in sorted(os.listdir(STATIC_DIR)):
+        mimetype = STATIC_TYPES.get(os.path.splitext(name)[1])
+        if mimetype is None:
+            continue
+        with open(os.path.join(STATIC_DIR, name), 'rb') as f:
+            raw = f.read()
+        assets[name] = {
+            'mimetype': mimetype,
+            'etag': hashlib.sha256(raw).hexdigest()[:16],
+            'identity': raw,
+            'gzip': gzip.compress(raw, compresslevel=9),
+            'br': brotli.compress(raw, quality=11),
+        }
+    return assets
+
+STATIC_ASSETS = load_static_assets()
+
+# The page only depends on MODEL and the asset versions, which are fixed at startup, so it is rendered once
+INDEX_HTML_RENDERED = (
+    INDEX_HTML.replace('%MODEL%', MODEL)
+    .replace('%APP_CSS_VERSION%', STATIC_ASSETS['app.css']['etag'])
+    .replace('%APP_JS_VERSION%', STATIC_ASSETS['app.js']['etag'])
+    .encode('utf-8')
+)
+INDEX_ETAG = hashlib.sha256(INDEX_HTML_RENDERED).hexdigest()[:16]
+
 @app.route('/')
 def index():
-    # Inject model name into HTML for display
-    return render_template_string(INDEX_HTML.replace('%MODEL%', MODEL))
+    # Revalidated on every load (a 304 when unchanged) so a deploy's new asset versions are picked up at once
+    headers = {'Cache-Control': 'no-cache', 'ETag': f'"{INDEX_ETAG}"'}
+    if request.if_none_match.contains(INDEX_ETAG):
+        return Response(status=304, headers=headers)
+    return Response(INDEX_HTML_RENDERED, mimetype='text/html', headers=headers)
+
+@app.route('/static/<name>')
+def static_asset(name):
+    asset = STATIC_ASSETS.get(name)
+    if asset is None:
+        return jsonify({'error': 'not found'}), 404
+    # URLs carry ?v=<etag>, so a cached copy never goes stale; the ETag answers revalidations with a 304.
+    # Any other version (e.g. a page from before a deploy) gets today's bytes, but must not cache them under that URL.
+    versioned = request.args.get('v') == asset['etag']
+    headers = {'Cache-Control': 'public, max-age=31536000, immutable' if versioned else 'no-cache',
+               'ETag': f'"{asset["etag"]}"', 'Vary': 'Accept-Encoding'}
+    if request.if_none_match.contains(asset['etag']):
+        return Response(status=304, headers=headers)
+    for encoding in ('br', 'gzip'):
+        if request.accept_encodings[encoding]:
+            headers['Content-Encoding'] = encoding
+            return Response(asset[encoding], mimetype=asset['mimetype'], headers=headers)
+    return Response(asset['identity'], mimetype=asset['mimetype'], headers=headers)
 
 @app.route('/api/chat', methods=['POST'])
+@limiter.limit(CHAT_RATE_LIMIT)
+@limiter.limit(IP_RATE_LIMIT, key_func=get_remote_address)
 def chat():
     data = request.get_json(force=True)
-    messages = data.get('messages', [])
-    # Validate messages: must be list of {role, content}
-    if not isinstance(messages, list):
-        return jsonify({'error':'invalid messages'}), 400
-
-    # Convert browser history into OpenAI-style message list.
-    # We will add a friendly system prompt to keep tone cute.
-    system_prompt = (
-        "You are a friendly, concise, cute assistant that replies helpfully and briefly. "
-        "Keep responses pleasant and slightly playful, suitable for a pastel-themed chat UI."
-    )
-    openai_messages = [{'role':'system', 'content': system_prompt}]
-    for m in messages:
-        role = m.get('role')
-        content = m.get('content')
-        if role not in ('user','assistant') or not isinstance(content, str):
-            continue
-        openai_messages.append({'role': role, 'content': content})
+    # Validate message: the client only sends the newest user turn
+    try:
+        validate_chat_request(data)
+    except fastjsonschema.JsonSchemaException as e:
+        return jsonify({'error': 'invalid message: ' + e.message}), 400
+    message = data['message']
+
+    # The conversation so far is kept server-side; the new turn is recorded once it will be answered
+    sid = session_id()
+    if not begin_reply(sid):
+        return jsonify({'error': 'still answering the previous message'}), 409
+    upto, summary = histories.latest_summary(sid)
+    history = histories.load(sid, start=upto)
+    history.append({'role': 'user', 'content': message})
+
+    # Serve a cached reply when the latest user turn (in context) matches an earlier one that followed the
+    # same assistant reply, so a repeated follow-up ("another one") is not answered with an old reply
+    previous_reply = next((m['content'] for m in reversed(history[:-1]) if m['role'] == 'assistant'), '')
+    try:
+        cache_key = cache.embed_context([m['content'] for m in history if m['role'] == 'user'])
+        cached = cache.lookup(sid, cache_key, previous_reply)
+    except Exception as e:
+        app.logger.warning('semantic cache unavailable: %s', e)
+        cache_key = cached = None
+    if cached is not None:
+        histories.append(sid, 'user', message)
+        histories.append(sid, 'assistant', cached)
+        return sse_response(iter([sse_event({'delta': cached}), SSE_DONE]))
+
+    # Convert stored history into OpenAI-style message list.
+    openai_messages = build_prompt(sid, upto, summary, history)
+    if not within_token_budget(openai_messages):
+        return jsonify({'error': 'token rate limit exceeded, please wait a moment'}), 429
 
     try:
-        # Call OpenAI ChatCompletion
-        client = openai.OpenAI(api_key=OPENAI_API_KEY)
-        resp = client.chat.completions.create(
+        # Call OpenAI ChatCompletion; the request is sent here so auth/quota errors still surface as JSON
+        stream = client.chat.completions.create(
             model=MODEL,
             messages=openai_messages,
-            max_tokens=512,
             temperature=0.7,
+            stream=True,
+            **reply_budget(message),
         )
-
-        reply = resp.choices[0].message.content.strip()
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    histories.append(sid, 'user', message)
+
+    def generate():
+        # Forward the reply as server-sent events, a few deltas per event to keep framing overhead low
+        batch, parts, finish_reason = [], [], None
+        answered = False
+        try:
+            for chunk in stream:
+                if not chunk.choices:
+                    continue
+                batch.append(chunk.choices[0].delta.content or '')
+                finish_reason = chunk.choices[0].finish_reason or finish_reason
+                if len(batch) >= STREAM_BATCH_SIZE:
+                    parts.extend(batch)
+                    yield sse_event({'delta': ''.join(batch)})
+                    batch = []
+            if batch:
+                parts.extend(batch)
+                yield sse_event({'delta': ''.join(batch)})
+        except Exception as e:
+            yield sse_event({'error': str(e)})
+        else:
+            reply = ''.join(parts).strip()
+            histories.append(sid, 'assistant', reply)
+            answered = True
+            # A reply cut off at max_tokens is shown once but not served again from the cache
+            if cache_key is not None and reply and finish_reason != 'length':
+                try:
+                    cache.store(sid, cache_key, reply, previous_reply)
+                except Exception as e:
+                    app.logger.warning('semantic cache unavailable: %s', e)
+        finally:
+            # A failed or abandoned stream leaves no unanswered user turn for the next one to follow
+            if not answered:
+                histories.remove_last(sid, 'user')
+        yield SSE_DONE
+
+    return sse_response(stream_with_context(generate()))
+
+@app.route('/api/regenerate', methods=['POST'])
+@limiter.limit(CHAT_RATE_LIMIT)
+@limiter.limit(IP_RATE_LIMIT, key_func=get_remote_address)
+def regenerate():
+    data = request.get_json(force=True, silent=True) or {}
+    try:
+        validate_regenerate_request(data)
+    except fastjsonschema.JsonSchemaException as e:
+        return jsonify({'error': 'invalid request: ' + e.message}), 400
+    sid = session_id()
+    # The alternatives from an earlier call are kept server-side; the client only picks one by index
+    choice = data.get('choice')
+    if choice is not None:
+        reply = histories.choose_alternative(sid, choice)
+        if reply is None:
+            return jsonify({'error':'no such alternative'}), 400
         return jsonify({'reply': reply})
+
+    if not begin_reply(sid):
+        return jsonify({'error': 'still answering the previous message'}), 409
+    upto, summary = histories.latest_summary(sid)
+    history = histories.load(sid, start=upto)
+    if not history:
+        return jsonify({'error':'nothing to regenerate'}), 400
+    # Re-answer the latest user turn, replacing the assistant reply to it if there is one
+    replacing = history[-1]['role'] == 'assistant'
+    prompt = build_prompt(sid, upto, summary, history[:-1] if replacing else history)
+    if not within_token_budget(prompt):
+        return jsonify({'error': 'token rate limit exceeded, please wait a moment'}), 429
+    try:
+        # One request returns every alternative, sharing the prompt's prefill instead of paying for it n times
+        resp = client.chat.completions.create(
+            model=MODEL,
+            messages=prompt,
+            temperature=0.9,
+            n=REGENERATE_CHOICES,
+            **reply_budget(prompt[-1]['content']),
+        )
+        # A choice can come back without content (e.g. finish_reason='content_filter')
+        replies = [(c.message.content or '').strip() for c in sorted(resp.choices, key=lambda c: c.index)]
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+    if replacing:
+        histories.replace_last(sid, 'assistant', replies[0])
+    else:
+        histories.append(sid, 'assistant', replies[0])
+    histories.store_alternatives(sid, replies)
+    return jsonify({'replies': replies})
+
+def begin_reply(sid):
+    """Mark `sid` as replying until this request's response is closed; False if a reply is already running."""
+    if not histories.begin_reply(sid, REPLY_TIMEOUT):
+        return False
+
+    @after_this_request
+    def end_reply(response):
+        # Runs once a streamed response has been fully sent (or the client went away), not when it is returned
+        response.call_on_close(lambda: histories.end_reply(sid))
+        return response
+    return True
+
+def within_token_budget(messages):
+    # Charge the prompt's tokens to both the session's and the IP's bucket; False once either is used up
+    tokens = sum(tok_count(m['content']) for m in messages)
+    buckets = [(TOKEN_RATE_LIMIT, rate_limit_key()), (IP_TOKEN_RATE_LIMIT, get_remote_address())]
+    if not all(limiter.limiter.test(limit, 'prompt-tokens', key, cost=tokens) for limit, key in buckets):
+        return False
+    return all([limiter.limiter.hit(limit, 'prompt-tokens', key, cost=tokens) for limit, key in buckets])
+
+def reply_budget(message):
+    """Return the max_tokens (and stop sequences) to answer `message` with."""
+    if SHORT_PROMPT_RE.match(message):
+        return {'max_tokens': SHORT_REPLY_TOKENS, 'stop': ['\n\n']}
+    return {'max_tokens': MAX_REPLY_TOKENS}
+
+def build_prompt(sid, upto, summary, messages):
+    """Return the OpenAI message list: system prompt, running summary (if any), then the messages after it.
+
+    `messages` are the session's messages from position `upto` on and `summary` covers everything before.
+    When the conversation gets too long, whole SUMMARY_CHUNKs are folded into the summary and stored, so
+    later turns start from the same prefix instead of re-summarising on every turn.
+    """
+    # Older messages (e.g. long code dumps) keep only their head and tail; the newest turn stays intact
+    messages = [*({'role': m['role'], 'content': truncate(m['content'])} for m in messages[:-1]), *messages[-1:]]
+    total_tokens = sum(tok_count(m['content']) for m in messages)
+    over_budget = total_tokens > CONTEXT_TOKENS or len(messages) > MAX_HISTORY_MESSAGES
+    fold = (len(messages) - HISTORY_WINDOW) // SUMMARY_CHUNK * SUMMARY_CHUNK
+    if over_budget and fold > 0:
+        head, messages = messages[:fold], messages[fold:]
+        try:
+            summary = summarize(summary, head)
+            histories.store_summary(sid, upto + fold, summary)
+        except Exception as e:
+            app.logger.warning('could not summarize history: %s', e)
+    prompt = [SYSTEM_MSG]
+    if summary:
+        prompt.append({'role': 'system', 'content': 'Summary of the earlier conversation: ' + summary})
+    prompt.extend(messages)
+    return prompt
+
+def truncate(content, limit=MESSAGE_KEEP_CHARS):
+    if len(content) <= limit:
+        return content
+    return content[:limit // 2] + f"\n…[{len(content) - limit} chars omitted]…\n" + content[-(limit // 2):]
+
+def summarize(summary, messages):
+    # Cumulative: the previous summary plus the newly folded messages become the new summary
+    resp = client.chat.completions.create(
+        model=SUMMARY_MODEL,
+        messages=[
+            {'role': 'system', 'content': 'Update the summary of this conversation with the new messages, in at '
+                                          'most 200 tokens. Keep facts, names and open questions the assistant '
+                                          'may need later.'},
+            {'role': 'user', 'content': orjson.dumps({'summary': summary or '', 'new_messages': messages}).decode('utf-8')},
+        ],
+        max_tokens=220,
+        temperature=0,
+    )
+    return resp.choices[0].message.content.strip()
+
+SSE_DONE = b"data: [DONE]\n\n"
+
+def sse_event(payload):
+    return b"data: " + orjson.dumps(payload) + b"\n\n"
+
+def sse_response(events):
+    return Response(events, mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+def session_id():
+    # Opaque per-browser id used to namespace server-side state; the cookie is issued on first use
+    if 'sid' not in g:
+        g.sid = request.cookies.get(SESSION_COOKIE)
+        g.new_sid = not g.sid
+        if g.new_sid:
+            g.sid = uuid.uuid4().hex
+    return g.sid
+
+@app.errorhandler(429)
+def rate_limited(e):
+    return jsonify({'error': 'rate limit exceeded: ' + str(e.description)}), 429
+
+@app.after_request
+def issue_session_cookie(response):
+    if g.get('new_sid'):
+        response.set_cookie(SESSION_COOKIE, g.sid, max_age=30 * 24 * 3600, httponly=True, samesite='Lax')
+    return response
+
 if __name__ == '__main__':
-    # For local demo use simple server
-    app.run(host='0.0.0.0', port=7860, debug=True)
+    # For local demo use simple server; production runs under gunicorn + gevent via wsgi.py
+    app.run(host='0.0.0.0', port=7860, debug=os.environ.get('FLASK_DEBUG') == '1')
@@ -0,0 +1,14 @@
+"""
+Production entry point.
+
+gevent must patch the standard library (sockets, ssl, threading) before the app and the OpenAI/httpx
+client are imported, so that every outbound call to OpenAI yields to other requests instead of blocking
+the worker.
+
+Run: gunicorn -k gevent -w 4 --worker-connections 1000 -b 0.0.0.0:7860 wsgi:app
+"""
+from gevent import monkey
+
+monkey.patch_all()
+
+from webapp import app  # noqa: E402